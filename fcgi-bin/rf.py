@@ -1,11 +1,16 @@
+import atexit
 import logging
+import struct
 import time
 from collections import namedtuple
 
-from RPi import GPIO
+import pigpio
 
 _LOGGER = logging.getLogger(__name__)
 
+# raised by pigpio calls once the daemon is gone, a closed socket shows up as a short read
+_PIGPIO_ERRORS = (pigpio.error, OSError, struct.error)
+
 RFProtocol = namedtuple('RFProtocol',
                       ['pulselength', 'repeat_delay',
                        'sync_count', 'sync_delay',
@@ -46,12 +51,18 @@ DEVICE_CODES = {
                          }
                       }
 
+# devices addressed by each name the web UI sends
+DEVICE_GROUPS = {dev: (dev,) for dev in DEVICE_CODES}
+DEVICE_GROUPS["lroom"] = ("lroom_l", "lroom_m", "lroom_r")
+
 class RFDevice:
 
     def __init__(self, gpio=17,
                  tx_proto=1, tx_pulselength=None, tx_repeat=8, tx_length=40):
         """Initialize the RF device."""
         self.gpio = gpio
+        # GPSET0/GPCLR0 bit of the pin, as used by pigpio pulses
+        self._gpio_mask = 1 << gpio
         self.tx_enabled = False
         self.tx_proto = tx_proto
         if tx_pulselength:
@@ -63,31 +74,72 @@ class RFDevice:
         self.tx_sync_delay = PROTOCOLS[tx_proto].sync_delay
         self.tx_repeat = tx_repeat
         self.tx_length = tx_length
+        # pulse trains already built for the current timing, by code
+        self._pulse_timing = None
+        self._pulse_cache = {}
 
-        GPIO.setmode(GPIO.BCM)
+        # pigpiod keeps the pin mode between client connections, so the pin
+        # is set up once; each command opens its own short-lived connection
+        self.pi = None
+        self._pin_ready = False
+        atexit.register(self.cleanup)
         _LOGGER.debug("Using GPIO " + str(gpio))
 
     def cleanup(self):
-        """Disable TX and clean up GPIO."""
-        if self.tx_enabled:
-            self.disable_tx()
+        """Disable TX and reset GPIO."""
+        self.disable_tx()
+        if self._pin_ready:
+            self._pin_ready = False
+            if self._connect():
+                try:
+                    # set up GPIO pin as input for safety
+                    self.pi.set_mode(self.gpio, pigpio.INPUT)
+                except _PIGPIO_ERRORS:
+                    _LOGGER.error("Lost connection to pigpio daemon, GPIO not reset")
+                self._disconnect()
         _LOGGER.debug("Cleanup")
-        GPIO.cleanup()
+
+    def _connect(self):
+        """Open a pigpio connection, False if the daemon is not running."""
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            _LOGGER.error("pigpio daemon is not running")
+            self._disconnect()
+            return False
+        return True
+
+    def _disconnect(self):
+        """Close the pigpio connection along with its exit handler."""
+        pi, self.pi = self.pi, None
+        if pi is None:
+            return
+        try:
+            pi.stop()
+        except _PIGPIO_ERRORS:
+            pass
+        # pigpio registers one atexit handler per connection
+        atexit.unregister(pi.stop)
 
     def enable_tx(self):
-        """Enable TX, set up GPIO."""
+        """Enable TX, connect to pigpiod and set up GPIO on first use."""
         if not self.tx_enabled:
+            if not self._connect():
+                # pigpiod may come back restarted, set the pin up again then
+                self._pin_ready = False
+                return False
+            if not self._pin_ready:
+                self.pi.set_mode(self.gpio, pigpio.OUTPUT)
+                self.pi.write(self.gpio, 0)
+                self._pin_ready = True
             self.tx_enabled = True
-            GPIO.setup(self.gpio, GPIO.OUT)
             _LOGGER.debug("TX enabled")
         return True
 
     def disable_tx(self):
-        """Disable TX, reset GPIO."""
+        """Disable TX and disconnect, the GPIO pin stays a low output."""
         if self.tx_enabled:
-            # set up GPIO pin as input for safety
-            GPIO.setup(self.gpio, GPIO.IN)
             self.tx_enabled = False
+            self._disconnect()
             _LOGGER.debug("TX disabled")
         return True
 
@@ -107,116 +159,138 @@ class RFDevice:
             self.tx_pulselength = PROTOCOLS[self.tx_proto].pulselength
         if tx_length:
             self.tx_length = tx_length
-        rawcodes = []
-        for code in codes:
-            rawcode = format(code, '#0{}b'.format(self.tx_length + 2))[2:]
-            _LOGGER.debug("TX code: " + str(rawcode))
-            rawcodes.append(rawcode)
-        return self._tx_bin(rawcodes)
-
-    def _tx_bin(self, rawcodes):
-        """Send a binary code, consider sync, delay and repeat parameters based on protocol."""
-        _LOGGER.debug("TX bin: {}" + str(rawcodes))
-        sent = ""
-
-        for code in rawcodes:
-            for _ in range(0, self.tx_repeat):
-                for x in range(self.tx_sync_count):
-                    sent += "$"
-                    if not self._tx_sync():
-                        return False
-                if (self.tx_sync_delay > 0):
-                    sent += "&"
-                    if not self._tx_delay(self.tx_sync_delay):
-                        return False
-                for byte in range(0, self.tx_length):
-                    if code[byte] == '0':
-                        sent += "0"
-                        if not self._tx_l0():
-                            return False
-                    else:
-                        sent += "1"
-                        if not self._tx_l1():
-                            return False
-                sent += "|"
-                if not self._tx_delay(self.tx_repeat_delay):
-                    return False
-        #_LOGGER.debug("sent: {}".format(sent))
-        return True
-
-    def _tx_l0(self):
-        """Send a '0' bit."""
         if not 0 < self.tx_proto < len(PROTOCOLS):
             _LOGGER.error("Unknown TX protocol")
             return False
-        return self._tx_waveform(PROTOCOLS[self.tx_proto].zero_high,
-                                PROTOCOLS[self.tx_proto].zero_low)
+        proto = PROTOCOLS[self.tx_proto]
+        timing = (proto, self.tx_pulselength,
+                  self.tx_sync_count, self.tx_sync_delay,
+                  self.tx_repeat_delay, self.tx_length)
+        if timing != self._pulse_timing:
+            self._pulse_timing = timing
+            self._pulse_cache = {}
+            self._tx_prepare(proto, self.tx_pulselength)
+        return self._tx_bin(codes)
 
-    def _tx_l1(self):
-        """Send a '1' bit."""
-        if not 0 < self.tx_proto < len(PROTOCOLS):
-            _LOGGER.error("Unknown TX protocol")
-            return False
-        return self._tx_waveform(PROTOCOLS[self.tx_proto].one_high,
-                                PROTOCOLS[self.tx_proto].one_low)
+    def _tx_prepare(self, proto, pulselength):
+        """
+        Prebuild the pulses that only depend on the protocol, times in microseconds.
+        pigpio packs pulse delays as unsigned ints, so times are rounded here.
+        """
+        def micros(t):
+            return int(round(t))
 
-    def _tx_sync(self):
-        """Send a sync."""
-        if not 0 < self.tx_proto < len(PROTOCOLS):
-            _LOGGER.error("Unknown TX protocol")
-            return False
-        return self._tx_waveform_irregular(PROTOCOLS[self.tx_proto].sync_high,
-                                PROTOCOLS[self.tx_proto].sync_low)
+        # pulses of a '0' and a '1' bit, indexed by the bit value
+        self._bit_pulses = ([], [])
+        self._tx_waveform(self._bit_pulses[0],
+                          micros(proto.zero_high * pulselength), micros(proto.zero_low * pulselength))
+        self._tx_waveform(self._bit_pulses[1],
+                          micros(proto.one_high * pulselength), micros(proto.one_low * pulselength))
+        # syncs opening each repeat and the gap closing it
+        self._head_pulses = []
+        self._head_sent = "$" * self.tx_sync_count
+        for x in range(self.tx_sync_count):
+            self._tx_waveform(self._head_pulses, micros(proto.sync_high), micros(proto.sync_low))
+        if (self.tx_sync_delay > 0):
+            self._head_sent += "&"
+            self._tx_delay(self._head_pulses, micros(self.tx_sync_delay))
+        # the repeat gap is just a long low pulse timed by pigpiod,
+        # so no CPU is spent waiting it out
+        self._tail_pulses = []
+        self._tx_delay(self._tail_pulses, micros(self.tx_repeat_delay))
 
-    def _tx_delay(self, delay):
-        """Wait between repeats."""
+    def _tx_bin(self, codes):
+        """
+        Send codes, consider sync, delay and repeat parameters based on protocol.
+        Each code is one pigpio waveform, repeated by a single wave chain,
+        so the pin is clocked by DMA instead of being toggled from Python.
+        Pulse trains are built once per code and reused until the timing changes.
+        """
         if not self.tx_enabled:
             _LOGGER.error("TX is not enabled, not sending data")
             return False
-        GPIO.output(self.gpio, GPIO.LOW)
-        self._sleep((delay) / 1000000)
-        return True
+        _LOGGER.debug("TX codes: " + str(codes))
+        debug = _LOGGER.isEnabledFor(logging.DEBUG)
+        waves = []
 
-    def _tx_waveform(self, highpulses, lowpulses):
-        """Send basic waveform."""
-        if not self.tx_enabled:
-            _LOGGER.error("TX is not enabled, not sending data")
-            return False
-        GPIO.output(self.gpio, GPIO.HIGH)
-        self._sleep((highpulses * self.tx_pulselength) / 1000000)
-        GPIO.output(self.gpio, GPIO.LOW)
-        self._sleep((lowpulses * self.tx_pulselength) / 1000000)
-        return True
+        for code in codes:
+            pulses = self._pulse_cache.get(code)
+            if pulses is None:
+                pulses = self._tx_pulses(code)
+                self._pulse_cache[code] = pulses
+            if debug:
+                _LOGGER.debug("sent: {}{:0{}b}| x{}".format(
+                    self._head_sent, code, self.tx_length, self.tx_repeat))
+            waves.append(pulses)
+        if not waves:
+            return True
+        return self._tx_waves(waves)
 
-    def _tx_waveform_irregular(self, highpulses, lowpulses):
-        """Send waveform without using regular pulse length."""
-        if not self.tx_enabled:
-            _LOGGER.error("TX is not enabled, not sending data")
-            return False
-        GPIO.output(self.gpio, GPIO.HIGH)
-        self._sleep((highpulses) / 1000000)
-        GPIO.output(self.gpio, GPIO.LOW)
-        self._sleep((lowpulses) / 1000000)
+    def _tx_pulses(self, code):
+        """Build the pulse train of one repeat of a code, sent MSB first."""
+        pulses = list(self._head_pulses)
+        bit_pulses = self._bit_pulses
+
+        for i in range(self.tx_length - 1, -1, -1):
+            pulses.extend(bit_pulses[(code >> i) & 1])
+        pulses.extend(self._tail_pulses)
+        return pulses
+
+    def _tx_delay(self, pulses, delay):
+        """Add a wait between repeats."""
+        pulses.append(pigpio.pulse(0, self._gpio_mask, delay))
+
+    def _tx_waveform(self, pulses, high, low):
+        """Add basic waveform, times in microseconds."""
+        pulses.append(pigpio.pulse(self._gpio_mask, 0, high))
+        pulses.append(pigpio.pulse(0, self._gpio_mask, low))
+
+    def _tx_waves(self, waves):
+        """Send each pulse train tx_repeat times as one wave chain and wait until it is out."""
+        repeat = self.tx_repeat
+        micros = 0
+        wids = []
+        chain = []
+        self.pi.wave_clear()
+        for pulses in waves:
+            micros += sum(pulse.delay for pulse in pulses) * repeat
+            self.pi.wave_add_generic(pulses)
+            wid = self.pi.wave_create()
+            wids.append(wid)
+            # loop start, wave, loop end with a 16 bit repeat count
+            chain += [255, 0, wid, 255, 1, repeat & 0xFF, (repeat >> 8) & 0xFF]
+        self.pi.wave_chain(chain)
+        self._sleep_until(time.monotonic_ns() + micros * 1000)
+        while self.pi.wave_tx_busy():
+            time.sleep(0.001)
+        for wid in wids:
+            self.pi.wave_delete(wid)
         return True
 
-    def _sleep(self, delay):      
-        _delay = delay / 100
-        end = time.time() + delay - _delay
-        while time.time() < end:
-            time.sleep(_delay)
+    def _sleep_until(self, end):
+        """Sleep until a time.monotonic_ns() deadline."""
+        now = time.monotonic_ns()
+        while now < end:
+            time.sleep((end - now) / 1e9)
+            now = time.monotonic_ns()
 
     def tx_shutter_cmd(self, device, command):
         """Send command(s) to shutter device(s)."""
         command_list = []
 
-        for dev in DEVICE_CODES:
-            if device in dev:
-                cmd = DEVICE_CODES.get(dev).get(command)
-                if (cmd):
-                    command_list.append(cmd)
+        for dev in DEVICE_GROUPS.get(device, ()):
+            cmd = DEVICE_CODES[dev].get(command)
+            if (cmd):
+                command_list.append(cmd)
 
         if (command_list):
-            self.enable_tx()
-            self.tx_code(command_list)
-            self.cleanup()
+            try:
+                return self.enable_tx() and self.tx_code(command_list)
+            except _PIGPIO_ERRORS as err:
+                _LOGGER.error("Lost connection to pigpio daemon: " + str(err))
+                # pigpiod may have restarted, set the pin up again next time
+                self._pin_ready = False
+                return False
+            finally:
+                self.disable_tx()
         return True